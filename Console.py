@@ -1,23 +1,42 @@
 # triangle_bybit_bot.py — торговый бот с командой /status
-import ccxt.async_support as ccxt
+import ccxt.pro as ccxt
+import aiohttp
+import orjson
 import asyncio
 import os
+import sys
+import atexit
 import time
+import random
 import logging
+import logging.handlers
+import queue
 import html
+import ssl
+import bisect
+from aiolimiter import AsyncLimiter
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from typing import Optional
 from telegram import Bot, Update
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
 
 # === Настройка логирования ===
+# Записи форматируются в вызывающем коде, а вывод в консоль и файл
+# выполняет QueueListener в отдельном потоке, не блокируя цикл событий
+log_records = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("bot_debug.log")
-    ]
+    handlers=[logging.handlers.QueueHandler(log_records)]
+)
+log_listener = logging.handlers.QueueListener(
+    log_records,
+    logging.StreamHandler(),
+    logging.FileHandler("bot_debug.log")
 )
 logger = logging.getLogger('TriangleBot')
 logger.setLevel(logging.DEBUG if os.getenv("DEBUG") else logging.INFO)
@@ -31,50 +50,145 @@ IS_TESTNET = os.getenv("TESTNET", "false").lower() == "true"
 
 # === Параметры торговли ===
 COMMISSION_RATE = 0.001
+FEE_MULTIPLIER = 1 - COMMISSION_RATE
+FEE_MULTIPLIER_CUBED = FEE_MULTIPLIER ** 3
 MIN_PROFIT = 0.15
 MAX_PROFIT = 2.0
 TARGET_VOLUME_USDT = float(os.getenv("TRADE_VOLUME", "10"))
 START_COINS = ['USDT', 'BTC', 'ETH']
 LOG_FILE = "trades.csv"
 MAX_SLIPPAGE = 0.005
-MAX_RETRIES = 3
+MAX_RETRIES = 2
 RETRY_DELAY = 1.5
+RETRY_BASE_DELAY = 0.2
+SYMBOL_FAILURE_COOLDOWN = 30
 MAX_CONCURRENT_TRADES = 1
 MIN_BALANCE_USDT = 15
 
+# === Ограничение нагрузки на API ===
+ORDERBOOK_RATE_LIMIT = int(os.getenv("ORDERBOOK_RATE_LIMIT", "50"))
+MAX_CONCURRENT_FETCHES = int(os.getenv("MAX_CONCURRENT_FETCHES", "20"))
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "20"))
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 30
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_DNS_CACHE_TTL = 600
+HTTP_TIMEOUT_MS = 5000
+
+# === Потоковые стаканы (WebSocket) ===
+ORDERBOOK_DEPTH = 50
+ORDERBOOK_SUBSCRIBE_CONCURRENCY = 10
+ORDERBOOK_SUBSCRIBE_TIMEOUT = 5
+TICKER_PROFIT_MARGIN = 0.3
+
+# === Пакетная отправка в Telegram ===
+TELEGRAM_FLUSH_INTERVAL = float(os.getenv("TELEGRAM_FLUSH_INTERVAL", "3"))
+TELEGRAM_BATCH_MAX_MESSAGES = int(os.getenv("TELEGRAM_BATCH_MAX_MESSAGES", "20"))
+TELEGRAM_MAX_LENGTH = 4096
+TELEGRAM_QUEUE_LIMIT = 200
+TELEGRAM_SEND_ATTEMPTS = 3
+TELEGRAM_BATCH_SEPARATOR = "\n\n——\n\n"
+LINE_EMOJI = {"green": "🟢", "yellow": "🟡", "red": "🔴"}
+LINE_TEMPLATE = "%s %d. %s - %.6f (%s), исполнено $%.2f, доступно $%.2f"
+STATUS_SETTINGS_BLOCK = (
+    f"⚙️ <b>Текущие настройки:</b>\n"
+    f"Объем: ${TARGET_VOLUME_USDT:.2f}\n"
+    f"Мин. прибыль: {MIN_PROFIT}%\n"
+    f"Макс. прибыль: {MAX_PROFIT}%"
+)
+
+# === Фоновая запись журнала сделок ===
+LOG_FLUSH_INTERVAL = 5
+LOG_BUFFER_SIZE = 1 << 16
+
 # === Лимиты сделок для защиты от блокировки ===
 MAX_TRADES_PER_MINUTE = int(os.getenv("MAX_TRADES_PER_MINUTE", "5"))
 MAX_TRADES_PER_HOUR = int(os.getenv("MAX_TRADES_PER_HOUR", "30"))
 MAX_TRADES_PER_DAY = int(os.getenv("MAX_TRADES_PER_DAY", "100"))
+# Окна от короткого к длинному: (длина в секундах, лимит, название)
+TRADE_LIMIT_WINDOWS = (
+    (60, MAX_TRADES_PER_MINUTE, "минутный"),
+    (3600, MAX_TRADES_PER_HOUR, "часовой"),
+    (86400, MAX_TRADES_PER_DAY, "дневной"),
+)
 
 # === Защитные механизмы ===
-TRADE_COOLDOWN = timedelta(minutes=5)
+TRADE_COOLDOWN_SEC = 300.0
 BALANCE_REFRESH_INTERVAL = 3600
 SYMBOL_REFRESH_INTERVAL = 86400
 TRIANGLE_HOLD_TIME = 10
+MIN_LEG_GAP = 0.1
+TRIANGLE_SCORE_ALPHA = 0.1
+
+# === Состояние торговли ===
+@dataclass(slots=True)
+class BotState:
+    """Изменяемое состояние бота, общее для всех корутин"""
+    active_trades: dict = field(default_factory=dict)
+    # Маршрут (base, mid1, mid2) -> time.monotonic() последней сделки
+    last_trade_cooldown: dict = field(default_factory=dict)
+    trade_history: deque = field(default_factory=deque)
+    current_balances: dict = field(default_factory=dict)
+    last_balance_refresh: float = float('-inf')
+    trade_limits_suspended: bool = False
+    balance_warning_sent: bool = False
+    scanning_active: bool = True
+    total_triangles_checked: int = 0
+    last_trade_at: Optional[datetime] = None
+    last_trade_profit: float = 0.0
+    last_trade_route: str = ""
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+# Единственный экземпляр состояния; функции обращаются к нему напрямую
+state = BotState()
 
 # === Глобальные состояния ===
-active_trades = {}
-trade_history = []
 symbols_cache = {}
 markets_cache = {}
 triangles_cache = []
-last_symbol_refresh = 0
-last_balance_refresh = 0
-current_balances = {}
-trade_limits_suspended = False
-balance_warning_sent = False
-bot_start_time = time.time()
-total_triangles_checked = 0
-last_trade_time = None
-last_trade_profit = 0.0
-last_trade_route = ""
-scanning_active = True
+triangles_key = None
+last_symbol_refresh = float('-inf')
+bot_start_time = time.monotonic()
+orderbook_limiter = AsyncLimiter(ORDERBOOK_RATE_LIMIT, 1)
+orderbook_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+order_books = {}
+order_book_tasks = {}
+order_book_requests = {}
+order_book_subscribe_semaphore = asyncio.Semaphore(ORDERBOOK_SUBSCRIBE_CONCURRENCY)
+triangle_skip_cache = {}
+triangle_scores = {}
+symbol_cooldowns = {}
+telegram_queue = asyncio.Queue(TELEGRAM_QUEUE_LIMIT)
+telegram_pending = asyncio.Event()
+telegram_send_lock = asyncio.Lock()
+telegram_flusher_task = None
+log_queue = asyncio.Queue()
+log_writer_task = None
+scan_queue = asyncio.Queue()
+scan_worker_tasks = []
 
 # === Инициализация биржи ===
+def use_orjson_responses(client):
+    """Разбор JSON-ответов через orjson, если ccxt не требует чисел строками
+    
+    При quoteJsonNumbers (по умолчанию включен) ccxt декодирует числа строками,
+    чтобы не терять точность; orjson так не умеет и вернул бы float/int,
+    поэтому в этом режиме остается штатный разбор ccxt.
+    """
+    default_on_json_response = client.on_json_response
+    
+    def on_json_response(response_body):
+        if client.quoteJsonNumbers:
+            return default_on_json_response(response_body)
+        return orjson.loads(response_body)
+    
+    client.on_json_response = on_json_response
+
 def init_exchange():
+    # Темп запросов стаканов задает orderbook_limiter
     exchange_options = {
-        "enableRateLimit": True,
+        "enableRateLimit": False,
+        "timeout": HTTP_TIMEOUT_MS,
         "apiKey": API_KEY,
         "secret": API_SECRET,
         "options": {"defaultType": "spot"}
@@ -89,41 +203,63 @@ def init_exchange():
     else:
         logger.info("Режим РЕАЛЬНОЙ СЕТИ активирован")
     
-    return ccxt.bybit(exchange_options)
+    bybit = ccxt.bybit(exchange_options)
+    use_orjson_responses(bybit)
+    return bybit
 
 exchange = init_exchange()
 
-# Инициализация файла лога
-if not os.path.exists(LOG_FILE):
-    with open(LOG_FILE, "w") as f:
-        f.write("timestamp,route,profit_percent,volume_usdt,status,details\n")
+def open_exchange_session():
+    """Общая HTTP-сессия биржи с постоянными соединениями"""
+    # Те же TLS-настройки (CA из certifi) и прокси, что в exchange.open() ccxt
+    ssl_context = ssl.create_default_context(cafile=exchange.cafile) if exchange.verify else False
+    connector = aiohttp.TCPConnector(
+        ssl=ssl_context,
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True
+    )
+    # ccxt закрывает сессию сам в exchange.close()
+    exchange.session = aiohttp.ClientSession(
+        connector=connector,
+        trust_env=exchange.aiohttp_trust_env
+    )
+
+# Инициализация файла лога: один дескриптор на все время работы
+new_log_file = not os.path.exists(LOG_FILE)
+trade_log_file = open(LOG_FILE, "a", buffering=LOG_BUFFER_SIZE)
+if new_log_file:
+    trade_log_file.write("timestamp,route,profit_percent,volume_usdt,status,details\n")
+    trade_log_file.flush()
+atexit.register(trade_log_file.close)
 
 # === Telegram Handlers ===
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /status"""
     try:
         # Рассчитываем время работы бота
-        uptime_seconds = time.time() - bot_start_time
+        uptime_seconds = time.monotonic() - bot_start_time
         uptime = timedelta(seconds=int(uptime_seconds))
         
         # Статус сканирования
-        scan_status = "✅ АКТИВНО" if scanning_active else "⛔️ ОСТАНОВЛЕНО"
+        scan_status = "✅ АКТИВНО" if state.scanning_active else "⛔️ ОСТАНОВЛЕНО"
         
         # Статус торговли
-        trade_status = "⛔️ ПРИОСТАНОВЛЕНА" if trade_limits_suspended else "✅ АКТИВНА"
+        trade_status = "⛔️ ПРИОСТАНОВЛЕНА" if state.trade_limits_suspended else "✅ АКТИВНА"
         
         # Баланс USDT
-        usdt_balance = current_balances.get('USDT', 0)
+        usdt_balance = state.current_balances.get('USDT', 0)
         balance_status = "✅ Достаточный" if usdt_balance >= MIN_BALANCE_USDT else f"⚠️ Низкий ({usdt_balance:.2f} USDT)"
         
         # Последняя сделка
         last_trade_info = "Нет данных"
-        if last_trade_time:
-            last_trade_delta = datetime.utcnow() - last_trade_time
+        if state.last_trade_at:
             last_trade_info = (
-                f"Время: {last_trade_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"Маршрут: {last_trade_route}\n"
-                f"Прибыль: {last_trade_profit:.2f}%"
+                f"Время: {state.last_trade_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"Маршрут: {state.last_trade_route}\n"
+                f"Прибыль: {state.last_trade_profit:.2f}%"
             )
         
         # Формируем сообщение
@@ -131,14 +267,11 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "🤖 <b>СТАТУС БОТА</b>\n\n"
             f"⏱ <b>Время работы:</b> {uptime}\n"
             f"🔍 <b>Сканирование:</b> {scan_status}\n"
-            f"🔁 <b>Проверено треугольников:</b> {total_triangles_checked}\n"
+            f"🔁 <b>Проверено треугольников:</b> {state.total_triangles_checked}\n"
             f"💼 <b>Торговый статус:</b> {trade_status}\n"
             f"💰 <b>Баланс USDT:</b> {balance_status}\n\n"
             f"📊 <b>Последняя сделка:</b>\n{last_trade_info}\n\n"
-            f"⚙️ <b>Текущие настройки:</b>\n"
-            f"Объем: ${TARGET_VOLUME_USDT:.2f}\n"
-            f"Мин. прибыль: {MIN_PROFIT}%\n"
-            f"Макс. прибыль: {MAX_PROFIT}%"
+            + STATUS_SETTINGS_BLOCK
         )
         
         await update.message.reply_text(message, parse_mode=ParseMode.HTML)
@@ -164,13 +297,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /balance"""
     try:
-        await refresh_balances(force=True)
-        if not current_balances:
+        balances = await refresh_balances(force=True)
+        if not balances:
             await update.message.reply_text("Не удалось получить баланс")
             return
             
         message = ["💰 <b>Текущий баланс:</b>"]
-        for coin, amount in current_balances.items():
+        for coin, amount in balances.items():
             if amount > 0.001:
                 message.append(f"{coin}: {amount:.6f}")
         
@@ -181,32 +314,63 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def scan_on_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /scan_on"""
-    global scanning_active
-    scanning_active = True
+    state.scanning_active = True
     await update.message.reply_text("✅ Сканирование треугольников возобновлено")
 
 async def scan_off_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /scan_off"""
-    global scanning_active
-    scanning_active = False
+    state.scanning_active = False
     await update.message.reply_text("⛔️ Сканирование треугольников приостановлено")
 
 async def refresh_symbols(force=False):
-    global symbols_cache, markets_cache, triangles_cache, last_symbol_refresh
+    global symbols_cache, markets_cache, triangles_cache, triangles_key, last_symbol_refresh
     
-    current_time = time.time()
+    current_time = time.monotonic()
     if not force and current_time - last_symbol_refresh < SYMBOL_REFRESH_INTERVAL:
         return symbols_cache, markets_cache, triangles_cache
     
     try:
         logger.debug("Обновление списка торговых пар...")
-        markets = await exchange.load_markets()
-        symbols = list(markets.keys())
+        # reload=True: без него ccxt возвращает рынки из своего кеша
+        markets = await exchange.load_markets(True)
+        symbols = frozenset(markets)
+        
+        # Треугольники строятся только из спотовых пар; опционы и срочные
+        # фьючерсы истекают ежедневно и не должны сбрасывать кеш маршрутов
+        spot_markets = {symbol: market for symbol, market in markets.items() if market.get('spot')}
+        
+        # Минимальные объемы пар не меняются до следующего обновления
+        min_amounts = {
+            symbol: ((market.get('limits') or {}).get('amount') or {}).get('min') or 0.0
+            for symbol, market in spot_markets.items()
+        }
+        
+        # Маршруты зависят от набора спотовых пар и их минимальных объемов;
+        # если ни то ни другое не изменилось - пересчет не нужен
+        key = frozenset(min_amounts.items())
+        if key == triangles_key:
+            symbols_cache = symbols
+            markets_cache = markets
+            last_symbol_refresh = current_time
+            logger.debug(f"Пары и лимиты не изменились, используется {len(triangles_cache)} треугольников")
+            return symbols_cache, markets_cache, triangles_cache
+        
+        # Индексы пар: котируемая валюта -> базовые, (базовая, котируемая) -> символ
+        by_quote = {}
+        pairs = {}
+        for symbol in spot_markets:
+            if '/' not in symbol:
+                continue
+            base_asset, quote_asset = symbol.split('/', 1)
+            by_quote.setdefault(quote_asset, []).append(base_asset)
+            pairs[(base_asset, quote_asset)] = symbol
         
         symbols_cache = symbols
         markets_cache = markets
-        triangles_cache = await find_triangles(symbols)
+        triangles_cache = find_triangles(by_quote, pairs, min_amounts, TARGET_VOLUME_USDT)
+        triangles_key = key
         last_symbol_refresh = current_time
+        sync_order_book_watchers(triangles_cache)
         
         logger.info(f"Обновлено {len(symbols)} пар, найдено {len(triangles_cache)} треугольников")
         return symbols_cache, markets_cache, triangles_cache
@@ -214,41 +378,46 @@ async def refresh_symbols(force=False):
         logger.error(f"Ошибка обновления пар: {str(e)}")
         return symbols_cache, markets_cache, triangles_cache
 
-async def find_triangles(symbols):
+def find_triangles(by_quote, pairs, min_amounts, target_volume):
+    """Маршруты base -> mid1 -> mid2 -> base по индексам пар
+    
+    Каждый маршрут хранится вместе с символами ног и строкой маршрута
+    для сообщений и журнала. Маршруты, у которых
+    минимальный объем первой пары не позволяет торговать target_volume,
+    отбрасываются сразу и в сканировании не участвуют.
+    """
     triangles = []
     for base in START_COINS:
-        for sym1 in symbols:
-            if not sym1.endswith('/' + base): 
+        for mid1 in by_quote.get(base, ()):
+            s1 = pairs[(mid1, base)]
+            if target_volume < min_amounts.get(s1, 0.0) * 10:
                 continue
-            mid1 = sym1.split('/')[0]
-            for sym2 in symbols:
-                if not sym2.startswith(mid1 + '/'): 
-                    continue
-                mid2 = sym2.split('/')[1]
-                third = f"{mid2}/{base}"
-                if third in symbols:
-                    triangles.append((base, mid1, mid2))
+            for mid2 in by_quote.get(mid1, ()):
+                s3 = pairs.get((mid2, base))
+                if s3 is not None:
+                    s2 = pairs[(mid2, mid1)]
+                    route = format_route((base, mid1, mid2))
+                    triangles.append((base, mid1, mid2, s1, s2, s3, route))
     return triangles
 
-async def get_avg_price(orderbook_side, target_usdt):
-    total_base = 0
-    total_usd = 0
-    max_liquidity = 0
+def get_avg_price(orderbook_side, target_usdt):
+    """Средняя цена исполнения объема target_usdt по уровням стакана"""
+    total_base = 0.0
+    total_usd = 0.0
+    max_liquidity = 0.0
     
+    # Уровни ccxt уже содержат float, приведение типов не нужно
     for price, volume in orderbook_side:
-        price = float(price)
-        volume = float(volume)
         usd = price * volume
         max_liquidity += usd
         
-        if total_usd + usd >= target_usdt:
-            remain_usd = target_usdt - total_usd
+        remain_usd = target_usdt - total_usd
+        if usd >= remain_usd:
             total_base += remain_usd / price
-            total_usd += remain_usd
+            total_usd = target_usdt
             break
-        else:
-            total_base += volume
-            total_usd += usd
+        total_base += volume
+        total_usd += usd
     
     if total_usd < target_usdt * 0.9:
         return None, 0, max_liquidity
@@ -256,38 +425,192 @@ async def get_avg_price(orderbook_side, target_usdt):
     avg_price = total_usd / total_base
     return avg_price, total_usd, max_liquidity
 
-async def get_execution_price(symbol, side, target_usdt):
-    for attempt in range(MAX_RETRIES):
+async def watch_order_book_loop(symbol):
+    """Поддерживает локальную копию стакана по WebSocket"""
+    first_subscribe = True
+    while True:
         try:
-            orderbook = await exchange.fetch_order_book(symbol, limit=20)
-            if side == "buy":
-                return await get_avg_price(orderbook['asks'], target_usdt)
+            if first_subscribe:
+                # Подписки открываются порциями, а не все сразу при старте.
+                # Ожидание первых данных ограничено, чтобы тихая пара не держала слот;
+                # повторные подписки после ошибок через этот слот не проходят
+                first_subscribe = False
+                async with order_book_subscribe_semaphore:
+                    orderbook = await asyncio.wait_for(
+                        exchange.watch_order_book(symbol, limit=ORDERBOOK_DEPTH),
+                        ORDERBOOK_SUBSCRIBE_TIMEOUT
+                    )
             else:
-                return await get_avg_price(orderbook['bids'], target_usdt)
+                orderbook = await exchange.watch_order_book(symbol, limit=ORDERBOOK_DEPTH)
+            order_books[symbol] = (orderbook['bids'], orderbook['asks'])
+        except asyncio.CancelledError:
+            order_books.pop(symbol, None)
+            raise
+        except asyncio.TimeoutError:
+            # Подписка уже отправлена - первые данные ждем без слота
+            continue
         except Exception as e:
-            logger.warning(f"Ошибка стакана {symbol} (попытка {attempt+1}): {str(e)}")
+            order_books.pop(symbol, None)
+            logger.warning(f"Ошибка потока стакана {symbol}: {str(e)}")
             await asyncio.sleep(RETRY_DELAY)
+
+def sync_order_book_watchers(triangles):
+    """Запускает подписки на стаканы пар из треугольников и снимает лишние"""
+    needed = set()
+    for _, _, _, s1, s2, s3, _ in triangles:
+        needed.update((s1, s2, s3))
+    
+    for symbol in list(order_book_tasks):
+        if symbol not in needed:
+            order_book_tasks.pop(symbol).cancel()
     
-    return None, 0, 0
+    for symbol in needed:
+        if symbol not in order_book_tasks:
+            order_book_tasks[symbol] = asyncio.create_task(watch_order_book_loop(symbol))
+    
+    logger.info(f"Подписки на стаканы: {len(order_book_tasks)}")
 
-def format_line(index, pair, price, side, volume_usd, color, liquidity):
-    emoji = {"green": "🟢", "yellow": "🟡", "red": "🔴"}.get(color, "")
+def cached_order_book(symbol):
+    """(bids, asks) из WebSocket, пока подписка пары работает, иначе None
+    
+    Тихий стакан без обновлений остается актуальным: при обрыве потока
+    watch_order_book_loop сам удаляет его из order_books.
+    """
+    task = order_book_tasks.get(symbol)
+    if task is None or task.done():
+        return None
+    return order_books.get(symbol)
+
+def top_of_book_key(*book_sides):
+    """Хеш верхних уровней тех сторон стаканов, по которым считается цена"""
+    return hash(tuple(tuple(book_side[0]) if book_side else None for book_side in book_sides))
+
+def remember_unprofitable(route_key, book_key, profit_percent=None):
+    """Запоминает неприбыльный маршрут до изменения верха стаканов"""
+    if book_key is not None:
+        triangle_skip_cache[route_key] = (book_key, profit_percent)
+
+def cached_order_book_side(symbol, side):
+    """Сторона стакана из WebSocket: asks для покупки, bids для продажи"""
+    cached = cached_order_book(symbol)
+    if not cached:
+        return None
+    bids, asks = cached
+    return asks if side == "buy" else bids
+
+async def fetch_order_book_side(symbol, side):
+    """Сторона стакана через REST, когда подписки WebSocket нет"""
+    # Пара недавно исчерпала попытки - не нагружаем API повторно
+    if time.monotonic() < symbol_cooldowns.get(symbol, 0):
+        return None
     
-    # Экранирование специальных символов для HTML
-    safe_pair = html.escape(pair)
-    safe_side = html.escape(side)
+    # Одновременные запросы одной пары из разных треугольников - один REST-вызов
+    request = order_book_requests.get(symbol)
+    if request is None:
+        request = asyncio.create_task(fetch_order_book_rest(symbol))
+        order_book_requests[symbol] = request
+        request.add_done_callback(lambda _: order_book_requests.pop(symbol, None))
     
-    return f"{emoji} {index}. {safe_pair} - {price:.6f} ({safe_side}), исполнено ${volume_usd:.2f}, доступно ${liquidity:.2f}"
+    # shield: отмена одного ожидающего не прерывает запрос для остальных
+    orderbook = await asyncio.shield(request)
+    if orderbook is None:
+        return None
+    return orderbook['asks'] if side == "buy" else orderbook['bids']
+
+async def fetch_order_book_rest(symbol):
+    """Стакан через REST с повторами; None и охлаждение пары при неудаче"""
+    delay = RETRY_BASE_DELAY
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with orderbook_semaphore, orderbook_limiter:
+                return await exchange.fetch_order_book(symbol, limit=20)
+        except Exception as e:
+            logger.warning(f"Ошибка стакана {symbol} (попытка {attempt+1}): {str(e)}")
+            if attempt + 1 < MAX_RETRIES:
+                # Экспоненциальная пауза со случайным разбросом
+                await asyncio.sleep(delay + random.random() * delay)
+                delay *= 2
+    
+    symbol_cooldowns[symbol] = time.monotonic() + SYMBOL_FAILURE_COOLDOWN
+    return None
+
+def format_line(index, pair, price, side, volume_usd, color, liquidity):
+    # Пара берётся из рынков биржи, сторона — константа, экранирование не нужно
+    return LINE_TEMPLATE % (LINE_EMOJI.get(color, ""), index, pair, price, side, volume_usd, liquidity)
 
 async def send_telegram_message(text, important=False):
+    """Ставит сообщение в очередь; важные сообщения отправляются сразу"""
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         return
     
+    if important:
+        # Сначала отправляем накопленное, чтобы сохранить порядок; блокировка
+        # не дает обогнать пачку, которую флашер отправляет прямо сейчас
+        async with telegram_send_lock:
+            await send_telegram_batch(drain_telegram_queue())
+            await deliver_telegram_message(text, important=True)
+        return
+    
+    try:
+        telegram_queue.put_nowait(text)
+        telegram_pending.set()
+    except asyncio.QueueFull:
+        logger.warning("Очередь Telegram переполнена, сообщение отброшено")
+
+def split_telegram_batch(messages):
+    """Склеивает сообщения в части не длиннее лимита Telegram"""
+    chunks = []
+    current = ""
+    for text in messages:
+        text = text[:TELEGRAM_MAX_LENGTH]
+        candidate = f"{current}{TELEGRAM_BATCH_SEPARATOR}{text}" if current else text
+        if len(candidate) > TELEGRAM_MAX_LENGTH:
+            chunks.append(current)
+            candidate = text
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+def drain_telegram_queue(limit=None):
+    pending = []
+    while not telegram_queue.empty() and (limit is None or len(pending) < limit):
+        pending.append(telegram_queue.get_nowait())
+    return pending
+
+async def send_telegram_batch(messages):
+    for chunk in split_telegram_batch(messages):
+        await deliver_telegram_message(chunk)
+
+async def flush_telegram_queue():
+    """Отправляет все накопленные сообщения пачками"""
+    async with telegram_send_lock:
+        await send_telegram_batch(drain_telegram_queue())
+
+async def send_telegram_queue_batch():
+    """Отправляет одну пачку из очереди, не более TELEGRAM_BATCH_MAX_MESSAGES"""
+    async with telegram_send_lock:
+        await send_telegram_batch(drain_telegram_queue(TELEGRAM_BATCH_MAX_MESSAGES))
+
+async def telegram_flusher():
+    """Ждет первое сообщение и через TELEGRAM_FLUSH_INTERVAL отправляет пачку"""
+    while True:
+        # Сообщения остаются в очереди до отправки, чтобы важное
+        # сообщение могло отправить их раньше себя
+        await telegram_pending.wait()
+        await asyncio.sleep(TELEGRAM_FLUSH_INTERVAL)
+        telegram_pending.clear()
+        # shield: остановка не обрывает уже взятую из очереди пачку
+        await asyncio.shield(send_telegram_queue_batch())
+        if not telegram_queue.empty():
+            telegram_pending.set()
+
+async def deliver_telegram_message(text, important=False):
     try:
         # Для важных сообщений используем HTML-разметку, но экранируем текст
         if important:
-            # Экранируем весь текст, кроме тегов
-            safe_text = text.replace('<', '&lt;').replace('>', '&gt;')
+            # Единственное место экранирования: весь текст, кроме тегов
+            safe_text = html.escape(text, quote=False)
             safe_text = safe_text.replace('&lt;b&gt;', '<b>').replace('&lt;/b&gt;', '</b>')
             safe_text = safe_text.replace('&lt;i&gt;', '<i>').replace('&lt;/i&gt;', '</i>')
             parse_mode = ParseMode.HTML
@@ -297,39 +620,87 @@ async def send_telegram_message(text, important=False):
         
         logger.debug(f"Отправка Telegram: {safe_text[:100]}...")
         
-        await telegram_app.bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID, 
-            text=safe_text, 
-            parse_mode=parse_mode,
-            disable_web_page_preview=True
-        )
+        for attempt in range(TELEGRAM_SEND_ATTEMPTS):
+            try:
+                await telegram_app.bot.send_message(
+                    chat_id=TELEGRAM_CHAT_ID, 
+                    text=safe_text, 
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True
+                )
+                return
+            except RetryAfter as e:
+                # Telegram ограничил частоту - ждем указанное время и повторяем
+                if attempt == TELEGRAM_SEND_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Лимит Telegram, повтор через {e.retry_after} сек")
+                await asyncio.sleep(e.retry_after)
     except Exception as e:
         logger.error(f"Ошибка Telegram: {str(e)}")
 
-def log_trade(base, mid1, mid2, profit, volume, status, details=""):
+def log_trade(route, profit, volume, status, details=""):
+    """Ставит строку сделки в очередь фоновой записи"""
+    log_queue.put_nowait(f"{datetime.utcnow()},{route},{profit:.4f},{volume},{status},{details}\n")
+
+def write_log_rows(f, rows):
     try:
-        with open(LOG_FILE, "a") as f:
-            route = f"{base}->{mid1}->{mid2}->{base}"
-            f.write(f"{datetime.utcnow()},{route},{profit:.4f},{volume},{status},{details}\n")
+        f.write("".join(rows))
+        f.flush()
     except Exception as e:
         logger.error(f"Ошибка записи лога: {str(e)}")
 
+def drain_log_queue():
+    rows = []
+    while not log_queue.empty():
+        rows.append(log_queue.get_nowait())
+    return rows
+
+async def write_log_rows_in_thread(rows):
+    """Пишет строки в потоке; отмена дожидается конца записи, а не бросает ее"""
+    write = asyncio.ensure_future(asyncio.to_thread(write_log_rows, trade_log_file, rows))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # Поток продолжит писать в trade_log_file - закрывать файл раньше нельзя
+        await write
+        raise
+
+async def trade_log_writer():
+    """Копит строки сделок LOG_FLUSH_INTERVAL секунд и дописывает их в CSV"""
+    while True:
+        rows = [await log_queue.get()]
+        try:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        finally:
+            # При остановке накопленные строки тоже записываются
+            rows.extend(drain_log_queue())
+            await write_log_rows_in_thread(rows)
+
 async def refresh_balances(force=False):
-    global current_balances, last_balance_refresh, balance_warning_sent
-    
-    current_time = time.time()
-    if not force and current_time - last_balance_refresh < BALANCE_REFRESH_INTERVAL:
-        return current_balances
+    current_time = time.monotonic()
+    if not force and current_time - state.last_balance_refresh < BALANCE_REFRESH_INTERVAL:
+        return state.current_balances
     
     try:
         logger.debug("Обновление балансов...")
-        balances = await exchange.fetch_balance()
-        current_balances = {k: float(v) for k, v in balances["total"].items() if float(v) > 0}
-        last_balance_refresh = current_time
+        async with state.lock:
+            # Пока ждали блокировку, балансы мог обновить другой вызов
+            if state.last_balance_refresh >= current_time:
+                return state.current_balances
+            
+            # Момент запроса, а не ответа: снимок не новее начала fetch_balance,
+            # и вызов, пришедший во время запроса, повторит его сам
+            fetch_started = time.monotonic()
+            totals = (await exchange.fetch_balance())["total"]
+            amounts = ((coin, float(value)) for coin, value in totals.items() if value)
+            balances = {coin: amount for coin, amount in amounts if amount > 0}
+            # Замена словаря целиком: читатели видят либо старый, либо новый снимок
+            state.current_balances = balances
+            state.last_balance_refresh = fetch_started
         
-        usdt_balance = current_balances.get('USDT', 0)
+        usdt_balance = balances.get('USDT', 0)
         if usdt_balance < MIN_BALANCE_USDT:
-            if not balance_warning_sent:
+            if not state.balance_warning_sent:
                 faucet_link = "https://testnet.bybit.com/ru-RU/testnet/faucet" if IS_TESTNET else ""
                 msg = (
                     f"⚠️ НИЗКИЙ БАЛАНС! ⚠️\n"
@@ -337,60 +708,41 @@ async def refresh_balances(force=False):
                     f"Пополните баланс: {faucet_link}"
                 )
                 await send_telegram_message(msg, important=True)
-                balance_warning_sent = True
+                state.balance_warning_sent = True
         else:
-            balance_warning_sent = False
+            state.balance_warning_sent = False
         
-        return current_balances
+        return balances
     except Exception as e:
         logger.error(f"Ошибка баланса: {str(e)}")
-        return current_balances
+        return state.current_balances
 
 def check_trade_limits():
     """Проверяет все лимиты на количество сделок"""
-    global trade_limits_suspended
-    
-    now = time.time()
-    
-    # Проверка лимита на минуту
-    recent_minute = [t for t in trade_history if now - t < 60]
-    if len(recent_minute) >= MAX_TRADES_PER_MINUTE:
-        reason = f"Превышен минутный лимит ({MAX_TRADES_PER_MINUTE})"
-        if not trade_limits_suspended:
-            trade_limits_suspended = True
-            asyncio.create_task(send_telegram_message(
-                f"⛔️ ТОРГОВЛЯ ПРИОСТАНОВЛЕНА ⛔️\n{reason}", 
-                important=True
-            ))
-        return False, reason
-    
-    # Проверка лимита на час
-    recent_hour = [t for t in trade_history if now - t < 3600]
-    if len(recent_hour) >= MAX_TRADES_PER_HOUR:
-        reason = f"Превышен часовой лимит ({MAX_TRADES_PER_HOUR})"
-        if not trade_limits_suspended:
-            trade_limits_suspended = True
-            asyncio.create_task(send_telegram_message(
-                f"⛔️ ТОРГОВЛЯ ПРИОСТАНОВЛЕНА ⛔️\n{reason}", 
-                important=True
-            ))
-        return False, reason
-    
-    # Проверка лимита на день
-    recent_day = [t for t in trade_history if now - t < 86400]
-    if len(recent_day) >= MAX_TRADES_PER_DAY:
-        reason = f"Превышен дневной лимит ({MAX_TRADES_PER_DAY})"
-        if not trade_limits_suspended:
-            trade_limits_suspended = True
-            asyncio.create_task(send_telegram_message(
-                f"⛔️ ТОРГОВЛЯ ПРИОСТАНОВЛЕНА ⛔️\n{reason}", 
-                important=True
-            ))
-        return False, reason
+    now = time.monotonic()
+    
+    # История упорядочена по времени: сделки старше суток не влияют на лимиты
+    history = state.trade_history
+    while history and now - history[0] >= 86400:
+        history.popleft()
+    
+    # Один проход по окнам: счетчик окна - число сделок новее его начала
+    total = len(history)
+    for window, limit, name in TRADE_LIMIT_WINDOWS:
+        trades = total - bisect.bisect_right(history, now - window)
+        if trades >= limit:
+            reason = f"Превышен {name} лимит ({limit})"
+            if not state.trade_limits_suspended:
+                state.trade_limits_suspended = True
+                asyncio.create_task(send_telegram_message(
+                    f"⛔️ ТОРГОВЛЯ ПРИОСТАНОВЛЕНА ⛔️\n{reason}", 
+                    important=True
+                ))
+            return False, reason
     
     # Если все лимиты в норме, возобновляем торговлю
-    if trade_limits_suspended:
-        trade_limits_suspended = False
+    if state.trade_limits_suspended:
+        state.trade_limits_suspended = False
         asyncio.create_task(send_telegram_message(
             "✅ ТОРГОВЛЯ ВОЗОБНОВЛЕНА ✅\nЛимиты сброшены", 
             important=True
@@ -398,17 +750,27 @@ def check_trade_limits():
     
     return True, "OK"
 
-def can_execute_trade(route_id):
-    """Проверяет возможность выполнения сделки"""
+def format_route(route_key):
+    """Читаемый маршрут base->mid1->mid2->base из ключа (base, mid1, mid2)"""
+    base, mid1, mid2 = route_key
+    return f"{base}->{mid1}->{mid2}->{base}"
+
+def route_on_cooldown(route_key, now):
+    """Проверяет, не торговался ли маршрут в пределах TRADE_COOLDOWN_SEC"""
+    last_time = state.last_trade_cooldown.get(route_key)
+    return bool(last_time and (now - last_time) < TRADE_COOLDOWN_SEC)
+
+def can_execute_trade(route_key=None, now=None):
+    """Проверяет возможность выполнения сделки; без route_key - для всех маршрутов"""
     # Проверка активных сделок
-    if len(active_trades) >= MAX_CONCURRENT_TRADES:
-        logger.warning(f"Превышен лимит активных сделок: {route_id}")
+    if len(state.active_trades) >= MAX_CONCURRENT_TRADES:
+        route = format_route(route_key) if route_key else "все маршруты"
+        logger.warning(f"Превышен лимит активных сделок: {route}")
         return False
     
     # Проверка времени последней сделки
-    last_time = last_trade_time.get(route_id)
-    if last_time and (datetime.utcnow() - last_time) < TRADE_COOLDOWN:
-        logger.debug(f"Торговля в режиме охлаждения: {route_id}")
+    if route_key is not None and route_on_cooldown(route_key, now or time.monotonic()):
+        logger.debug(f"Торговля в режиме охлаждения: {format_route(route_key)}")
         return False
     
     # Проверка лимитов на количество сделок
@@ -418,22 +780,29 @@ def can_execute_trade(route_id):
         return False
     
     # Проверка баланса USDT
-    usdt_balance = current_balances.get('USDT', 0)
+    usdt_balance = state.current_balances.get('USDT', 0)
     if usdt_balance < TARGET_VOLUME_USDT * 1.1:
         logger.warning(f"Недостаточный баланс USDT: {usdt_balance:.2f} < {TARGET_VOLUME_USDT * 1.1:.2f}")
         return False
     
     return True
 
-async def execute_real_trade(route_id, steps):
+async def execute_real_trade(route_key, steps, now):
     """Выполняет реальные торговые операции"""
     # Регистрируем начало сделки
-    active_trades[route_id] = datetime.utcnow()
-    trade_start = time.time()
+    state.active_trades[route_key] = now
+    trade_start = time.monotonic()
     
     trade_details = []
+    last_order_ts = None
     try:
         for i, (symbol, side, amount) in enumerate(steps):
+            # Пауза только если предыдущий ордер исполнился быстрее MIN_LEG_GAP
+            if last_order_ts is not None:
+                delay = MIN_LEG_GAP - (time.monotonic() - last_order_ts)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            
             logger.info(f"Исполнение ордера {i+1}/{len(steps)}: {symbol} {side} {amount:.6f}")
             
             # Создание рыночного ордера
@@ -444,71 +813,81 @@ async def execute_real_trade(route_id, steps):
                 amount=amount,
                 params={'timeInForce': 'IOC'}
             )
+            last_order_ts = time.monotonic()
             trade_details.append(order)
-            
-            # Пауза между ордерами для снижения нагрузки
-            if i < len(steps) - 1:
-                await asyncio.sleep(1.0)
-                
+        
         return True, trade_details
     except Exception as e:
         logger.error(f"Ошибка сделки: {str(e)}")
         return False, str(e)
     finally:
         # Снятие блокировки
-        active_trades.pop(route_id, None)
-        last_trade_time[route_id] = datetime.utcnow()
+        state.active_trades.pop(route_key, None)
+        state.last_trade_cooldown[route_key] = time.monotonic()
         
         # Регистрируем сделку в истории
-        trade_history.append(trade_start)
-        logger.info(f"Сделка завершена за {time.time() - trade_start:.2f} сек")
+        state.trade_history.append(trade_start)
+        logger.info(f"Сделка завершена за {time.monotonic() - trade_start:.2f} сек")
 
-async def check_triangle(base, mid1, mid2, symbols, markets):
-    global total_triangles_checked, last_trade_time, last_trade_profit, last_trade_route
-    
+async def check_triangle(base, mid1, mid2, s1, s2, s3, route, now):
     try:
-        route_id = f"{base}->{mid1}->{mid2}->{base}"
-        total_triangles_checked += 1
+        route_key = (base, mid1, mid2)
+        state.total_triangles_checked += 1
         
-        # Проверка доступности маршрута
-        s1 = f"{mid1}/{base}"
-        s2 = f"{mid2}/{mid1}"
-        s3 = f"{mid2}/{base}"
-        
-        if not (s1 in symbols and s2 in symbols and s3 in symbols):
+        # Маршрут на охлаждении - стаканы не нужны
+        if route_on_cooldown(route_key, now):
             return
         
-        # Проверка минимального объема
-        market_info = markets.get(s1)
-        if market_info and 'limits' in market_info:
-            min_amount = market_info['limits']['amount']['min']
-            if TARGET_VOLUME_USDT < min_amount * 10:
+        # Стаканы из WebSocket читаются сразу, параллельно запрашиваются только недостающие
+        legs = ((s1, "buy"), (s2, "buy"), (s3, "sell"))
+        sides = [cached_order_book_side(symbol, side) for symbol, side in legs]
+        missing = [i for i, book_side in enumerate(sides) if book_side is None]
+        
+        # Пропуск маршрута, если верх стаканов не изменился с прошлой неудачи.
+        # Ключ строится по тем же сторонам, что пойдут в расчет: между ключом
+        # и расчетом цены нет ожиданий, и стаканы не успевают измениться.
+        book_key = None
+        if not missing:
+            book_key = top_of_book_key(*sides)
+            skipped = triangle_skip_cache.get(route_key)
+            if skipped and skipped[0] == book_key:
                 return
-
-        # Получение цен исполнения
-        price1, vol1, liq1 = await get_execution_price(s1, "buy", TARGET_VOLUME_USDT)
-        if not price1 or vol1 < TARGET_VOLUME_USDT * 0.8:
+        else:
+            fetched = await asyncio.gather(*(fetch_order_book_side(*legs[i]) for i in missing))
+            for i, book_side in zip(missing, fetched):
+                sides[i] = book_side
+        side1, side2, side3 = sides
+        if side1 is None or side2 is None or side3 is None:
+            remember_unprofitable(route_key, book_key)
             return
-            
-        price2, vol2, liq2 = await get_execution_price(s2, "buy", vol1 * 0.99)
-        if not price2:
+        
+        # Цены исполнения на полный объем для каждой ноги
+        price1, vol1, liq1 = get_avg_price(side1, TARGET_VOLUME_USDT)
+        price2, vol2, liq2 = get_avg_price(side2, TARGET_VOLUME_USDT)
+        price3, vol3, liq3 = get_avg_price(side3, TARGET_VOLUME_USDT)
+        if not price1 or vol1 < TARGET_VOLUME_USDT * 0.8:
+            remember_unprofitable(route_key, book_key)
             return
-            
-        price3, vol3, liq3 = await get_execution_price(s3, "sell", vol2 * 0.99)
-        if not price3:
+        if not price2 or vol2 < vol1 * 0.99 or not price3 or vol3 < vol2 * 0.99:
+            remember_unprofitable(route_key, book_key)
             return
 
         # Расчет прибыли с учетом комиссий
-        step1 = (1 / price1) * (1 - COMMISSION_RATE)
-        step2 = step1 * (1 / price2) * (1 - COMMISSION_RATE)
-        step3 = step2 * price3 * (1 - COMMISSION_RATE)
+        inv_price12 = 1 / (price1 * price2)
+        step3 = FEE_MULTIPLIER_CUBED * price3 * inv_price12
         
         profit_percent = (step3 - 1) * 100
+        score = triangle_scores.get(route_key)
+        triangle_scores[route_key] = profit_percent if score is None else (
+            score + TRIANGLE_SCORE_ALPHA * (profit_percent - score)
+        )
         if not (MIN_PROFIT <= profit_percent <= MAX_PROFIT): 
+            remember_unprofitable(route_key, book_key, profit_percent)
             return
+        triangle_skip_cache.pop(route_key, None)
 
         # Проверка условий для исполнения
-        if not can_execute_trade(route_id):
+        if not can_execute_trade(route_key, now):
             return
 
         min_liquidity = min(liq1, liq2, liq3)
@@ -528,43 +907,122 @@ async def check_triangle(base, mid1, mid2, symbols, markets):
 
         # Отправка в Telegram
         await send_telegram_message("\n".join(message_lines))
-        log_trade(base, mid1, mid2, profit_percent, min_liquidity, "detected")
+        log_trade(route, profit_percent, min_liquidity, "detected")
 
         # Подготовка шагов сделки
         steps = [
             (s1, "buy", TARGET_VOLUME_USDT),
-            (s2, "buy", TARGET_VOLUME_USDT / price1 * (1 - COMMISSION_RATE)),
-            (s3, "sell", TARGET_VOLUME_USDT / price1 / price2 * (1 - 2*COMMISSION_RATE))
+            (s2, "buy", TARGET_VOLUME_USDT * FEE_MULTIPLIER / price1),
+            (s3, "sell", TARGET_VOLUME_USDT * inv_price12 * (1 - 2*COMMISSION_RATE))
         ]
 
         # Выполнение сделки
-        trade_success, trade_result = await execute_real_trade(route_id, steps)
+        trade_success, trade_result = await execute_real_trade(route_key, steps, now)
+        # После сделки стаканы и балансы изменились - остаток прохода не актуален
+        drain_scan_queue()
         
         if trade_success:
-            last_trade_time = datetime.utcnow()
-            last_trade_profit = profit_percent
-            last_trade_route = route_id
+            state.last_trade_at = datetime.utcnow()
+            state.last_trade_profit = profit_percent
+            state.last_trade_route = route
             
             profit_msg = f"✅ Сделка выполнена\nПрибыль: {pure_profit_usdt:.2f} USDT ({profit_percent:.2f}%)"
             await send_telegram_message(profit_msg, important=True)
-            log_trade(base, mid1, mid2, profit_percent, TARGET_VOLUME_USDT, "executed", str(trade_result))
+            log_trade(route, profit_percent, TARGET_VOLUME_USDT, "executed", str(trade_result))
         else:
-            # Экранирование текста ошибки
-            error_details = html.escape(str(trade_result)[:200])
+            error_details = str(trade_result)[:200]
             error_msg = f"❌ Ошибка сделки\n{error_details}"
             await send_telegram_message(error_msg, important=True)
-            log_trade(base, mid1, mid2, profit_percent, TARGET_VOLUME_USDT, "failed", str(trade_result))
+            log_trade(route, profit_percent, TARGET_VOLUME_USDT, "failed", str(trade_result))
             
         # Принудительное обновление баланса после сделки
         await refresh_balances(force=True)
             
     except Exception as e:
         logger.error(f"Ошибка треугольника: {str(e)}", exc_info=True)
-        # Экранирование текста ошибки
-        error_details = html.escape(str(e))[:100]
+        error_details = str(e)[:100]
         error_msg = f"⚠️ Ошибка обработки\n{error_details}"
         await send_telegram_message(error_msg, important=True)
 
+async def fetch_ticker_prices():
+    """Лучшие bid/ask всех спотовых пар одним запросом"""
+    try:
+        async with orderbook_limiter:
+            tickers = await exchange.fetch_tickers()
+    except Exception as e:
+        logger.warning(f"Ошибка получения тикеров: {str(e)}")
+        return {}
+    
+    return {
+        symbol: (ticker['bid'], ticker['ask'])
+        for symbol, ticker in tickers.items()
+        if ticker.get('bid') and ticker.get('ask')
+    }
+
+def top_of_book_candidates(triangles, ticker_prices):
+    """Индексы треугольников, не отсеянных по лучшим ценам стаканов и тикеров"""
+    best_prices = dict(ticker_prices)
+    live_symbols = set()
+    for symbol in order_books:
+        bids, asks = cached_order_book(symbol) or ((), ())
+        if bids and asks:
+            best_prices[symbol] = (bids[0][0], asks[0][0])
+            live_symbols.add(symbol)
+    
+    # Цена по глубине не лучше верхнего уровня, поэтому оценка сверху.
+    # Тикеры могут отставать от стакана, для них порог ниже на запас.
+    min_ratio = 1 + MIN_PROFIT / 100
+    ticker_min_ratio = 1 + (MIN_PROFIT - TICKER_PROFIT_MARGIN) / 100
+    candidates = []
+    for index, (_, _, _, s1, s2, s3, _) in enumerate(triangles):
+        top1 = best_prices.get(s1)
+        top2 = best_prices.get(s2)
+        top3 = best_prices.get(s3)
+        if top1 and top2 and top3:
+            if s1 in live_symbols and s2 in live_symbols and s3 in live_symbols:
+                ratio = min_ratio
+            else:
+                ratio = ticker_min_ratio
+            if FEE_MULTIPLIER_CUBED * top3[0] < ratio * top1[1] * top2[1]:
+                continue
+        candidates.append(index)
+    return candidates
+
+async def scan_worker():
+    """Проверяет треугольники по индексам из очереди сканирования"""
+    while True:
+        index, now = await scan_queue.get()
+        try:
+            await check_triangle(*triangles_cache[index], now)
+        finally:
+            scan_queue.task_done()
+
+def drain_scan_queue():
+    """Снимает из очереди сканирования еще не взятые воркерами треугольники"""
+    while not scan_queue.empty():
+        scan_queue.get_nowait()
+        scan_queue.task_done()
+
+async def scan_triangles(triangles, now):
+    """Раздает треугольники постоянным воркерам и ждет окончания прохода"""
+    # Если торговать сейчас нельзя, стаканы не запрашиваем вовсе
+    if not can_execute_trade(now=now):
+        return
+    
+    candidates = top_of_book_candidates(triangles, await fetch_ticker_prices())
+    state.total_triangles_checked += len(triangles) - len(candidates)
+    logger.debug(f"Кандидатов после отбора по верху стаканов: {len(candidates)}/{len(triangles)}")
+    
+    # Сначала маршруты с лучшей средней прибылью за прошлые проходы
+    candidates.sort(
+        key=lambda index: triangle_scores.get(triangles[index][:3], float('-inf')),
+        reverse=True
+    )
+    
+    for index in candidates:
+        scan_queue.put_nowait((index, now))
+    await scan_queue.join()
+
 async def check_exchange_connection():
     """Проверяет подключение к бирже"""
     try:
@@ -572,28 +1030,43 @@ async def check_exchange_connection():
         return True
     except Exception as e:
         logger.error(f"Ошибка подключения: {str(e)}")
-        error_details = html.escape(str(e))[:200]
+        error_details = str(e)[:200]
         error_msg = f"❌ Ошибка подключения к Bybit\n{error_details}"
         await send_telegram_message(error_msg, important=True)
         return False
 
 async def cleanup_old_data():
     """Очищает старые данные для экономии памяти"""
-    now = time.time()
-    
-    # Очистка истории сделок (старше 7 дней)
-    global trade_history
-    trade_history = [t for t in trade_history if now - t < 604800]
+    # История сделок обрезается до суток в check_trade_limits
     
-    # Очистка кеша последних сделок
-    global last_trade_time
-    cutoff = datetime.utcnow() - timedelta(days=7)
-    last_trade_time = {k: v for k, v in last_trade_time.items() if v > cutoff}
+    # Очистка кеша последних сделок на месте, без нового словаря
+    cutoff = time.monotonic() - 604800
+    for route_key, last_time in list(state.last_trade_cooldown.items()):
+        if last_time <= cutoff:
+            del state.last_trade_cooldown[route_key]
 
 async def safe_shutdown():
     """Безопасное завершение работы"""
     logger.info("Завершение работы...")
     try:
+        for task in order_book_tasks.values():
+            task.cancel()
+        order_book_tasks.clear()
+        for task in list(order_book_requests.values()):
+            task.cancel()
+        for task in scan_worker_tasks:
+            task.cancel()
+        scan_worker_tasks.clear()
+        if telegram_flusher_task:
+            telegram_flusher_task.cancel()
+            await asyncio.gather(telegram_flusher_task, return_exceptions=True)
+            await flush_telegram_queue()
+        if log_writer_task:
+            log_writer_task.cancel()
+            await asyncio.gather(log_writer_task, return_exceptions=True)
+        if not trade_log_file.closed:
+            write_log_rows(trade_log_file, drain_log_queue())
+            trade_log_file.close()
         await exchange.close()
         await telegram_app.stop()
         await telegram_app.shutdown()
@@ -604,7 +1077,7 @@ async def safe_shutdown():
 
 async def main_loop():
     """Основной цикл работы бота"""
-    global telegram_app, scanning_active
+    global telegram_app, telegram_flusher_task, log_writer_task
     
     telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
     
@@ -617,10 +1090,14 @@ async def main_loop():
     
     await telegram_app.initialize()
     await telegram_app.start()
+    telegram_flusher_task = asyncio.create_task(telegram_flusher())
+    log_writer_task = asyncio.create_task(trade_log_writer())
+    scan_worker_tasks.extend(asyncio.create_task(scan_worker()) for _ in range(SCAN_WORKERS))
     
     # Проверка подключения
+    open_exchange_session()
+    # Завершение выполняет main() - здесь только выход
     if not await check_exchange_connection():
-        await safe_shutdown()
         return
     
     # Начальные загрузки
@@ -630,12 +1107,12 @@ async def main_loop():
     
     # Основной цикл
     logger.info("Начало работы основного цикла")
-    last_balance_update = time.time()
-    last_cleanup = time.time()
+    last_balance_update = time.monotonic()
+    last_cleanup = time.monotonic()
     
     while True:
         try:
-            current_time = time.time()
+            current_time = time.monotonic()
             
             # Периодическое обновление данных
             if current_time - last_balance_update > BALANCE_REFRESH_INTERVAL:
@@ -648,7 +1125,7 @@ async def main_loop():
                 last_cleanup = current_time
             
             # Проверка минимального баланса
-            usdt_balance = current_balances.get('USDT', 0)
+            usdt_balance = state.current_balances.get('USDT', 0)
             if usdt_balance < MIN_BALANCE_USDT:
                 logger.warning(f"Недостаточный баланс USDT: {usdt_balance:.2f} < {MIN_BALANCE_USDT}")
                 # Ждем 5 минут перед следующей проверкой
@@ -660,10 +1137,9 @@ async def main_loop():
             symbols, markets, triangles = await refresh_symbols()
             
             # Проверка треугольников только если сканирование активно
-            if scanning_active:
-                tasks = [check_triangle(base, mid1, mid2, symbols, markets) 
-                         for base, mid1, mid2 in triangles]
-                await asyncio.gather(*tasks)
+            if state.scanning_active:
+                # Единая отметка времени на весь проход
+                await scan_triangles(triangles, time.monotonic())
             
             await asyncio.sleep(10)
             
@@ -674,22 +1150,25 @@ async def main_loop():
             await asyncio.sleep(30)
 
 async def main():
-    # Инициализация глобальных переменных
-    global trade_history, last_trade_time
-    global trade_limits_suspended, balance_warning_sent, scanning_active
-    
-    trade_history = []
-    last_trade_time = {}
-    trade_limits_suspended = False
-    balance_warning_sent = False
-    scanning_active = True
+    log_listener.start()
     
     try:
         await main_loop()
     except KeyboardInterrupt:
         logger.info("Получен сигнал прерывания")
     finally:
-        await safe_shutdown()
+        try:
+            await safe_shutdown()
+        finally:
+            # Останавливается один раз, после последних записей завершения
+            log_listener.stop()
 
 if __name__ == '__main__':
+    # Цикл событий на libuv вместо стандартного, если uvloop доступен
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.warning("uvloop не установлен, используется стандартный цикл событий")
     asyncio.run(main())
\ No newline at end of file